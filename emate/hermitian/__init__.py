@@ -1,4 +1,4 @@
-from emate.hermitian.kpm import pykpm, cupykpm, tfkpm
+from emate.hermitian.kpm import pykpm, cupykpm, tfkpm, clear_tfkpm_cache
 from emate.hermitian import tfops, cupyops
 
-__all__ = ["pykpm", "tfops", "cupykpm", "cupykpm", "tfkpm"]
+__all__ = ["pykpm", "tfops", "cupykpm", "cupykpm", "tfkpm", "clear_tfkpm_cache"]
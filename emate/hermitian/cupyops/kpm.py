@@ -19,48 +19,471 @@ Available functions
 
 
 """
+import functools
+import string
+import warnings
+
 import numpy as np
 try:
     import cupy as cp
+    from cupy import cusparse
 except:
     cp = None
 
+try:
+    from cupy import cublas
+except:
+    cublas = None
+
 from emate.utils.cupyops.signal import dctIII
+from emate.utils.cupyops.vector_factories import normal_complex, radamacher
+
+
+def _cheb_update(h_alpha1, alpha0):
+    return 2*h_alpha1 - alpha0
+
+
+def _damp_moments(moments, kernel, norm):
+    return cp.real(moments)*kernel/norm
+
+
+def _chebyshev_nodes(points, num_points):
+    ek = cp.cos(cp.pi*(points+0.5)/num_points)
+    gk = cp.pi*cp.sqrt(1.-ek*ek)
+    return ek, gk
+
+
+if cp is not None:
+    _cheb_update = cp.fuse()(_cheb_update)
+    _damp_moments = cp.fuse()(_damp_moments)
+    _chebyshev_nodes = cp.fuse()(_chebyshev_nodes)
+
+
+@functools.lru_cache(maxsize=32)
+def _get_chebyshev_nodes(num_points, device_id):
+    """
+    The nodes ek and the weights gk depend only on num_points, therefore
+    they are computed once per device. The returned arrays are shared and
+    must not be modified in place.
+    """
+    points = cp.arange(0, num_points, dtype=cp.float64)
+    nodes = _chebyshev_nodes(points, num_points)
+    # only a cache miss gets here; the other streams must see the values
+    cp.cuda.get_current_stream().synchronize()
+    return nodes
+
+
+_CHEB_STEP_BLOCK_SIZE = 256
+_CHEB_STEP_MAX_BLOCKS = 1024
+# number of columns each thread keeps in registers while walking a row
+_CHEB_STEP_VEC_CHUNK = 8
+
+_CHEB_STEP_SOURCE = r'''
+#include <cupy/complex.cuh>
+
+typedef ${value_type} T;
+typedef ${real_type} R;
+#define RE(x) ${re}
+#define IM(x) ${im}
+
+extern "C" __global__ void emate_cheb_step(
+    const int* indptr,
+    const int* indices,
+    const T* data,
+    const T* x1,
+    T* x0,
+    R* mu_even,
+    R* mu_odd,
+    const int n_rows,
+    const int n_vecs
+) {
+    __shared__ R s_even[${block_size}];
+    __shared__ R s_odd_re[${block_size}];
+    __shared__ R s_odd_im[${block_size}];
+
+    R even = 0;
+    R odd_re = 0;
+    R odd_im = 0;
+    // one thread per row: each data[j]/indices[j] is loaded once per
+    // chunk of ${vec_chunk} columns and reused for every column of the chunk
+    for (
+        int row = blockIdx.x*blockDim.x + threadIdx.x;
+        row < n_rows;
+        row += blockDim.x*gridDim.x
+    ) {
+        const int row_start = indptr[row];
+        const int row_end = indptr[row + 1];
+        for (int col0 = 0; col0 < n_vecs; col0 += ${vec_chunk}) {
+            const int n_cols = min(${vec_chunk}, n_vecs - col0);
+            T h_x1[${vec_chunk}];
+            #pragma unroll
+            for (int c = 0; c < ${vec_chunk}; c++) {
+                h_x1[c] = 0;
+            }
+            for (int j = row_start; j < row_end; j++) {
+                const T h = data[j];
+                // the vectors are F-ordered, column c starts at c*n_rows
+                const T* x1_j = x1 + (long long)col0*n_rows + indices[j];
+                #pragma unroll
+                for (int c = 0; c < ${vec_chunk}; c++) {
+                    if (c < n_cols) {
+                        h_x1[c] += h*x1_j[(long long)c*n_rows];
+                    }
+                }
+            }
+            #pragma unroll
+            for (int c = 0; c < ${vec_chunk}; c++) {
+                if (c < n_cols) {
+                    const long long idx = (long long)(col0 + c)*n_rows + row;
+                    const T a1 = x1[idx];
+                    const T a2 = h_x1[c] + h_x1[c] - x0[idx];
+                    x0[idx] = a2;
+
+                    even += RE(a1)*RE(a1) + IM(a1)*IM(a1);
+                    odd_re += RE(a2)*RE(a1) + IM(a2)*IM(a1);
+                    odd_im += RE(a2)*IM(a1) - IM(a2)*RE(a1);
+                }
+            }
+        }
+    }
+
+    s_even[threadIdx.x] = even;
+    s_odd_re[threadIdx.x] = odd_re;
+    s_odd_im[threadIdx.x] = odd_im;
+    __syncthreads();
+    for (int stride = blockDim.x/2; stride > 0; stride >>= 1) {
+        if (threadIdx.x < stride) {
+            s_even[threadIdx.x] += s_even[threadIdx.x + stride];
+            s_odd_re[threadIdx.x] += s_odd_re[threadIdx.x + stride];
+            s_odd_im[threadIdx.x] += s_odd_im[threadIdx.x + stride];
+        }
+        __syncthreads();
+    }
+
+    if (threadIdx.x == 0) {
+        atomicAdd(&mu_even[0], s_even[0]);
+        atomicAdd(&mu_odd[0], s_odd_re[0]);
+        if (${is_complex}) {
+            atomicAdd(&mu_odd[1], s_odd_im[0]);
+        }
+    }
+}
+'''
+
+
+@functools.lru_cache(maxsize=8)
+def _get_cheb_step_kernel(dtype):
+    """
+    RawKernel which computes a whole step of the recurrence in a single
+    pass: alpha2 = 2*H@alpha1 - alpha0, written over alpha0, and the
+    partial sums of <alpha1|alpha1> and <alpha2|alpha1>.
+
+    Each thread owns a row and loops over the columns in chunks of
+    _CHEB_STEP_VEC_CHUNK, so H is read ceil(num_vecs/_CHEB_STEP_VEC_CHUNK)
+    times per step instead of num_vecs times.
+    """
+    dtype = np.dtype(dtype)
+    real_type = {"f": "float", "d": "double"}[dtype.char.lower()]
+    if dtype.kind == "c":
+        value_type = "complex<%s>" % real_type
+        re, im = "(x).real()", "(x).imag()"
+    else:
+        value_type = real_type
+        re, im = "(x)", "R(0)"
+
+    source = string.Template(_CHEB_STEP_SOURCE).substitute(
+        value_type=value_type,
+        real_type=real_type,
+        re=re,
+        im=im,
+        is_complex=int(dtype.kind == "c"),
+        block_size=_CHEB_STEP_BLOCK_SIZE,
+        vec_chunk=_CHEB_STEP_VEC_CHUNK,
+    )
+    return cp.RawKernel(source, "emate_cheb_step")
+
+
+def _fused_cheb_step(H_rescaled, alpha1, alpha0, mu_even, mu_odd):
+    """
+    mu_even and mu_odd are 0-d views, filled with zeros, where the
+    kernel accumulates <alpha1|alpha1> and <alpha2|alpha1>.
+    """
+    n_rows, n_vecs = alpha1.shape
+    num_blocks = min(
+        -(-n_rows//_CHEB_STEP_BLOCK_SIZE), _CHEB_STEP_MAX_BLOCKS)
+    kernel = _get_cheb_step_kernel(H_rescaled.dtype)
+    kernel(
+        (num_blocks,),
+        (_CHEB_STEP_BLOCK_SIZE,),
+        (
+            H_rescaled.indptr,
+            H_rescaled.indices,
+            H_rescaled.data,
+            alpha1,
+            alpha0,
+            mu_even,
+            mu_odd,
+            np.int32(n_rows),
+            np.int32(n_vecs),
+        )
+    )
+    return alpha0
+
+
+def _cusparse_available(name):
+    check_availability = getattr(cusparse, "check_availability", None)
+    return check_availability is not None and check_availability(name)
+
+
+def _merge_path_aligned(H_rescaled, alpha):
+    """
+    csrmvEx needs 128-byte aligned vectors. The columns of the F-ordered
+    block start at multiples of the column stride, so all of them are
+    aligned only when the first one and the stride are.
+    """
+    x = alpha[:, 0]
+    return (
+        alpha.strides[1] % 128 == 0
+        and cusparse.csrmvExIsAligned(H_rescaled, x, x)
+    )
+
+
+def _spmv_method(H_rescaled, alpha, spmv="default"):
+    """
+    Chooses how the products H@alpha of the recurrence are evaluated.
+
+    "spmm" uses a single cuSPARSE SpMM for the whole block, "merge_path"
+    uses the merge-path csrmvEx for each random vector, "fused" uses a
+    RawKernel that also computes the inner products and "fuse" uses the
+    cupy product followed by a fused elementwise kernel.
+    """
+    if spmv not in ("default", "merge_path", "fused"):
+        raise ValueError(
+            "spmv must be 'default', 'merge_path' or 'fused', got %r" % (
+                spmv,))
+
+    if H_rescaled.dtype != alpha.dtype or not alpha.flags.f_contiguous:
+        return "fuse"
+
+    if spmv == "fused":
+        return "fused"
+
+    if spmv == "merge_path":
+        if not _cusparse_available("csrmvEx"):
+            warnings.warn(
+                "cusparse csrmvEx is not available, using the default SpMV")
+        elif not _merge_path_aligned(H_rescaled, alpha):
+            warnings.warn(
+                "csrmvEx needs 128-byte aligned vectors, but the random "
+                "vectors of dimension %d are not, using the default "
+                "SpMV" % alpha.shape[0])
+        else:
+            return "merge_path"
+
+    if _cusparse_available("spmm"):
+        return "spmm"
+
+    return "fuse"
+
+
+def _cheb_step(H_rescaled, alpha1, alpha0, method):
+    """
+    Next vector of the Chebyshev recurrence, 2*H@alpha1 - alpha0.
+
+    The result is always written in the alpha0 buffer. The cuSPARSE
+    methods do it in the product itself, C = alpha*A@B + beta*C,
+    otherwise the product is followed by a fused elementwise kernel.
+    """
+    if method == "spmm":
+        alpha2 = cusparse.spmm(
+            H_rescaled, alpha1, c=alpha0, alpha=2, beta=-1)
+        if alpha2 is not alpha0:
+            alpha0[...] = alpha2
+        return alpha0
+
+    if method == "merge_path":
+        # the load balance of merge-path does not depend on the row
+        # lengths, which helps matrices with a few very dense rows
+        # the alignment of every column was checked by _spmv_method
+        for i_vec in range(alpha1.shape[1]):
+            cusparse.csrmvEx(
+                H_rescaled, alpha1[:, i_vec], y=alpha0[:, i_vec],
+                alpha=2, beta=-1, merge_path=True)
+        return alpha0
+
+    alpha0[...] = _cheb_update(H_rescaled @ alpha1, alpha0)
+    return alpha0
+
+
+def _block_dots(alphas_flat, i_cur, out):
+    """
+    Both inner products of a step, <alphas_flat[:, k]|alpha1> for the two
+    halves k, in a single reduction. With cuBLAS it is one GEMV with the
+    conjugate transpose, which does not build the conjugate of alphas.
+    """
+    alpha1 = alphas_flat[:, i_cur]
+    if getattr(cublas, "gemv", None) is not None:
+        cublas.gemv("H", 1, alphas_flat, alpha1, beta=0, y=out)
+    else:
+        out[...] = cp.einsum("ik,i->k", alphas_flat.conj(), alpha1)
 
 
 def get_moments(
     H_rescaled,
     num_moments,
     dimension,
-    precision=32
+    num_vecs,
+    precision=32,
+    spmv="default",
+    sampler=None,
+    use_cuda_graph=False
 ):
     """
     Parameters
     ----------
-        H: sparse cupy of rank 2
+        H: sparse cupy of rank 2, real or complex
         num_moments: (uint) number of cheby. moments
         dimension: (uint) size of the matrix
+        num_vecs: (uint) number of random vectors
+        spmv: (str) "default", "merge_path" or "fused". "merge_path" uses
+            the merge-path cuSPARSE SpMV, which is faster for matrices with
+            an irregular number of non-zeros per row. "fused" uses a single
+            kernel per step for the product, the update and the inner
+            products, which reads the vectors only once and H once per
+            chunk of 8 vectors
+        sampler: (str) "radamacher" or "normal_complex", the random
+            vectors of the stochastic trace. Radamacher vectors are real,
+            so a real H runs the recurrence in real arithmetic, at the
+            cost of a larger variance than the unit-phase vectors of
+            normal_complex. If None, "radamacher" is used for a real H
+            and "normal_complex" for a complex one
+        use_cuda_graph: (bool) if True a pair of steps of the recurrence
+            is captured in a CUDA graph and replayed for the other pairs,
+            therefore the GPU runs them without the gaps of the kernel
+            launches
 
     Returns
     -------
+        mu: cupy array(shape=(num_moments,), dtype=cp_type)
+            moments summed over all the random vectors, cp_type is
+            real if both H and the random vectors are real
+
+    Note
+    ----
+        The random vectors are stored as the columns of a dense block,
+        therefore each step of the recurrence is a single sparse-matrix
+        times dense-matrix product (SpMM) instead of num_vecs SpMV's.
     """
-    cp_complex = cp.complex64
-    if precision == 64:
-        cp_complex = cp.complex128
-        
-    alpha0 = cp.exp(1j*2*cp.pi*cp.random.rand(dimension))
-    alpha1 = H_rescaled.dot(alpha0)
-    mu = cp.zeros(num_moments, dtype=cp_complex)
-    mu[0] = (alpha0.T.conj()).dot(alpha0)
-    mu[1] = (alpha0.T.conj()).dot(alpha1)
+    shape = (dimension, num_vecs)
+    if sampler is None:
+        # for a complex H the recurrence is complex anyway, so the
+        # vectors with the smaller variance are used
+        sampler = "radamacher"
+        if H_rescaled.dtype.kind == "c":
+            sampler = "normal_complex"
+
+    if sampler == "radamacher":
+        alpha0 = radamacher(shape, precision=precision)
+    elif sampler == "normal_complex":
+        alpha0 = normal_complex(shape, precision=precision)
+        if H_rescaled.dtype.kind != "c":
+            H_rescaled = H_rescaled.astype(
+                cp.result_type(H_rescaled.dtype, cp.complex64))
+            H_rescaled._has_canonical_format = True
+    else:
+        raise ValueError(
+            "sampler must be 'radamacher' or 'normal_complex', got %r" % (
+                sampler,))
+
+    if H_rescaled.dtype.kind == "c":
+        cp_type = cp.complex64
+        if precision == 64:
+            cp_type = cp.complex128
+    else:
+        cp_type = cp.float32
+        if precision == 64:
+            cp_type = cp.float64
+
+    # alpha0 and alpha1 are the two F-contiguous halves of a single
+    # buffer, the recurrence only swaps which half plays each role
+    alphas = cp.empty(
+        (dimension, num_vecs, 2), dtype=H_rescaled.dtype, order="F")
+    alphas[:, :, 0] = alpha0
+    alpha0 = alphas[:, :, 0]
+    alpha1 = alphas[:, :, 1]
+
+    method = _spmv_method(H_rescaled, alpha0, spmv)
+    if method == "spmm":
+        alpha1 = cusparse.spmm(H_rescaled, alpha0, c=alpha1)
+    else:
+        alpha1[...] = H_rescaled @ alpha0
+
+    # each entry of alpha0 has unit modulus, so <alpha0|alpha0> is known,
+    # and <alpha0|alpha1> is computed only once for the whole block
+    mu0 = num_vecs*dimension
+    mu1 = cp.einsum("ij,ij->", alpha0.conj(), alpha1)
 
-    for i_moment in range(1, num_moments//2):
-        alpha2 = 2*H_rescaled.dot(alpha1)-alpha0
-        mu[2*i_moment] = 2*(alpha1.T.conj()).dot(alpha1) - mu[0]
-        mu[2*i_moment+1] = 2*(alpha2.T.conj()).dot(alpha1) - mu[1]
+    # the raw inner products are stored in a preallocated array, the
+    # shift by the first two moments is applied once after the loop.
+    # dots[i_step, k] = <half k|alpha1>, where alpha1 is in the half
+    # i_cur and alpha2 is written over alpha0, in the other half
+    num_steps = num_moments//2 - 1
+    dots = cp.zeros((num_steps, 2), dtype=H_rescaled.dtype)
+    halves = (alphas[:, :, 0], alphas[:, :, 1])
+    alphas_flat = alphas.reshape((dimension*num_vecs, 2), order="F")
 
-        alpha0 = alpha1
-        alpha1 = alpha2
+    def cheb_step(i_cur, out):
+        alpha1 = halves[i_cur]
+        alpha0 = halves[1 - i_cur]
+        if method == "fused":
+            _fused_cheb_step(
+                H_rescaled, alpha1, alpha0, out[i_cur], out[1 - i_cur])
+        else:
+            _cheb_step(H_rescaled, alpha1, alpha0, method)
+            _block_dots(alphas_flat, i_cur, out)
+
+    if use_cuda_graph and not hasattr(cp.cuda.Stream, "begin_capture"):
+        warnings.warn(
+            "this cupy version can not capture CUDA graphs, the "
+            "recurrence is launched step by step")
+        use_cuda_graph = False
+
+    num_pairs = num_steps//2
+    if use_cuda_graph and num_pairs > 1:
+        stream = cp.cuda.Stream(non_blocking=True)
+        stream.wait_event(cp.cuda.get_current_stream().record())
+        pair_dots = cp.empty((2, 2), dtype=H_rescaled.dtype)
+        with stream:
+            # the first pair runs eagerly, so the memory pool of the stream
+            # already holds the blocks requested by each step
+            cheb_step(1, dots[0])
+            cheb_step(0, dots[1])
+            # after two steps the halves are back in the same roles, so a
+            # single pair is captured, writing in fixed slots, and replayed
+            stream.begin_capture()
+            pair_dots.fill(0)
+            cheb_step(1, pair_dots[0])
+            cheb_step(0, pair_dots[1])
+            graph = stream.end_capture()
+            for i_pair in range(1, num_pairs):
+                graph.launch()
+                dots[2*i_pair:2*i_pair+2] = pair_dots
+            if num_steps % 2:
+                cheb_step(1, dots[num_steps - 1])
+        cp.cuda.get_current_stream().wait_event(stream.record())
+    else:
+        for i_step in range(num_steps):
+            cheb_step((i_step + 1) % 2, dots[i_step])
+
+    # at the even steps alpha1 is the second half, so the pair is swapped
+    # and dots[:, 0] becomes <alpha1|alpha1> and dots[:, 1] <alpha2|alpha1>
+    dots[0::2] = dots[0::2, ::-1].copy()
+
+    mu = cp.zeros(num_moments, dtype=cp_type)
+    mu[0] = mu0
+    mu[1] = mu1
+    mu[2:2*num_steps+2:2] = 2*dots[:, 0] - mu0
+    mu[3:2*num_steps+3:2] = 2*dots[:, 1] - mu1
 
     return mu
 
@@ -76,29 +499,28 @@ def apply_kernel(
     """
     Parameters
     ----------
-    Apply a given kernel in a given array of moments.
+    Apply a given kernel in a given array of moments, already summed
+    over the random vectors.
     Return the cosine transform of type III.
     """
 
-    moments = cp.sum(moments.real, axis=0)
-    moments = moments/num_vecs/dimension
-
     num_points = extra_points+num_moments
 
-    if kernel is not None:
-        moments = moments*kernel
-
     mu_ext = cp.zeros(num_points)
-    mu_ext[0:num_moments] = moments
+    if kernel is not None:
+        mu_ext[0:num_moments] = _damp_moments(
+            moments, kernel, num_vecs*dimension)
+    else:
+        mu_ext[0:num_moments] = moments.real/(num_vecs*dimension)
 
     smooth_moments = dctIII(mu_ext)
-    points = cp.arange(0, num_points)
-    ek = cp.cos(cp.pi*(points+0.5)/num_points)
-    gk = cp.pi*cp.sqrt(1.-ek**2)
-   
+    ek, gk = _get_chebyshev_nodes(num_points, cp.cuda.Device().id)
+
     rho = cp.divide(smooth_moments, gk)
 
-    return ek, rho
+    # the cached nodes are shared between the calls, the caller gets its
+    # own copy
+    return ek.copy(), rho
 
 
 __all__ = ["apply_kernel", "get_moments"]
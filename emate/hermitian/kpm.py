@@ -30,6 +30,9 @@ Statistics-Simulation and Computation, 19(2), pp.433-450.
 
 =======
 """
+import collections
+import functools
+
 import numpy as np
 import tensorflow as tf
 try:
@@ -44,17 +47,162 @@ from emate.utils.tfops.vector_factories import normal_complex
 
 from emate.utils.tfops.kernels import jackson as tf_jackson
 from emate.utils.cupyops.kernels import jackson as cupy_jackson
+from emate.utils.cupyops.sparse import csr_to_cupy
 
 from emate.hermitian.tfops.kpm import get_moments, apply_kernel
 from emate.hermitian.cupyops import kpm as cupyops
 
 
+@functools.lru_cache(maxsize=32)
+def _cached_cupy_jackson(num_moments, precision, device_id):
+    """
+    The Jackson kernel depends only on num_moments and precision, so it
+    is computed once per device. The array is shared between the calls.
+    """
+    kernel = cupy_jackson(num_moments, precision=precision)
+    # the array may be read later from any stream, so it must be ready
+    # before it enters the cache
+    cp.cuda.get_current_stream().synchronize()
+    return kernel
+
+
+def _cupy_moments(
+    H,
+    num_moments,
+    dimension,
+    num_vecs,
+    num_streams=1,
+    **kwargs
+):
+    """
+    Splits the random vectors in num_streams blocks, each one with its
+    own recurrence in a non-blocking stream, so that the products of
+    small matrices, which do not fill the GPU, run concurrently.
+
+    Returns
+    -------
+        moments: cupy array(shape=(num_moments,))
+            moments summed over all the random vectors
+    """
+    num_streams = max(1, min(num_streams, num_vecs))
+    if num_streams == 1:
+        return cupyops.get_moments(
+            H, num_moments, dimension, num_vecs, **kwargs)
+
+    caller_stream = cp.cuda.get_current_stream()
+    ready = caller_stream.record()
+    moments = []
+    for i_stream in range(num_streams):
+        block_size = num_vecs//num_streams
+        if i_stream < num_vecs % num_streams:
+            block_size += 1
+
+        stream = cp.cuda.Stream(non_blocking=True)
+        stream.wait_event(ready)
+        with stream:
+            moments.append(cupyops.get_moments(
+                H, num_moments, dimension, block_size, **kwargs))
+        caller_stream.wait_event(stream.record())
+
+    return sum(moments[1:], moments[0])
+
+
 def rescale_kpm(ek, rho, scale_fact_a, scale_fact_b):
 
     ek = ek*scale_fact_a + scale_fact_b
     rho = rho/scale_fact_a
     return ek, rho
 
+
+def _build_tfkpm_graph(
+    shape,
+    tf_type,
+    num_moments,
+    num_vecs,
+    extra_points,
+    precision,
+    device
+):
+    """
+    Builds the tfkpm graph and the session that runs it. The graph
+    depends only on the arguments, while the values of the matrix are
+    fed at each run.
+
+    Returns
+    -------
+        sess: tf.compat.v1.Session
+        fetches: (Tensor, Tensor) ek and rho, before the rescale
+    """
+    dimension = shape[0]
+    graph = tf.Graph()
+    with graph.as_default(), tf.device(device):
+        sp_indices = tf.compat.v1.placeholder(
+            dtype=tf.int64, name="sp_indices")
+        sp_values = tf.compat.v1.placeholder(
+            dtype=tf_type,
+            name="sp_values"
+        )
+        H = tf.SparseTensor(
+            sp_indices,
+            sp_values,
+            dense_shape=np.array(shape, dtype=np.int32)
+        )
+
+        alpha0 = normal_complex(
+            shape=(dimension, num_vecs),
+            precision=precision
+        )
+        moments = get_moments(H, num_vecs, num_moments, alpha0)
+        kernel0 = tf_jackson(num_moments, precision=32)
+        if precision == 64:
+            moments = tf.cast(moments, tf.float32)
+        ek, rho = apply_kernel(
+            moments,
+            kernel0,
+            dimension,
+            num_moments,
+            num_vecs,
+            extra_points
+        )
+
+    sess = tf.compat.v1.Session(graph=graph)
+
+    return sess, (ek, rho)
+
+
+# the sessions hold device memory, so the cache is small and the evicted
+# sessions are closed
+_TFKPM_GRAPHS_MAXSIZE = 8
+_tfkpm_graphs = collections.OrderedDict()
+
+
+def _tfkpm_graph(*args):
+    """
+    Returns the cached session and fetches of _build_tfkpm_graph(*args),
+    so the graph is built only once for repeated calls with the same
+    parameters.
+    """
+    if args in _tfkpm_graphs:
+        _tfkpm_graphs.move_to_end(args)
+        return _tfkpm_graphs[args]
+
+    _tfkpm_graphs[args] = _build_tfkpm_graph(*args)
+    if len(_tfkpm_graphs) > _TFKPM_GRAPHS_MAXSIZE:
+        sess, _ = _tfkpm_graphs.popitem(last=False)[1]
+        sess.close()
+
+    return _tfkpm_graphs[args]
+
+
+def clear_tfkpm_cache():
+    """
+    Closes the sessions kept by tfkpm and releases their resources.
+    """
+    while _tfkpm_graphs:
+        sess, _ = _tfkpm_graphs.popitem()[1]
+        sess.close()
+
+
 def tfkpm(
     H,
     num_moments=10,
@@ -126,48 +274,29 @@ def tfkpm(
             tf_type = tf.float64
 
     sp_values = np.array(coo.data, dtype=np_type)
-    sp_indices = np.mat([coo.row, coo.col], dtype=np.int64).transpose()
+    sp_indices = np.stack(
+        (
+            coo.row.astype(np.int64, copy=False),
+            coo.col.astype(np.int64, copy=False)
+        ),
+        axis=1
+    )
 
+    sess, fetches = _tfkpm_graph(
+        H.shape,
+        tf_type,
+        num_moments,
+        num_vecs,
+        extra_points,
+        precision,
+        device
+    )
     feed_dict = {
         "sp_values:0": sp_values,
         "sp_indices:0": sp_indices,
     }
-
-    dimension = H.shape[0]
-
-    tf.compat.v1.reset_default_graph()
-    with tf.device(device):
-        sp_indices = tf.compat.v1.placeholder(dtype=tf.int64, name="sp_indices")
-        sp_values = tf.compat.v1.placeholder(
-            dtype=tf_type,
-            name="sp_values"
-        )
-        H = tf.SparseTensor(
-            sp_indices,
-            sp_values,
-            dense_shape=np.array(H.shape, dtype=np.int32)
-        )
-
-        alpha0 = normal_complex(
-            shape=(dimension, num_vecs),
-            precision=precision
-        )
-        moments = get_moments(H, num_vecs, num_moments, alpha0)
-        kernel0 = tf_jackson(num_moments, precision=32)
-        if precision == 64:
-            moments = tf.cast(moments, tf.float32)
-        ek, rho = apply_kernel(
-            moments,
-            kernel0,
-            dimension,
-            num_moments,
-            num_vecs,
-            extra_points
-        )
-        ek, rho = rescale_kpm(ek, rho, scale_fact_a, scale_fact_b)
-
-    with tf.compat.v1.Session() as sess:
-        ek, rho = sess.run([ek, rho], feed_dict)
+    ek, rho = sess.run(fetches, feed_dict)
+    ek, rho = rescale_kpm(ek, rho, scale_fact_a, scale_fact_b)
 
     return ek, rho
 
@@ -179,7 +308,12 @@ def cupykpm(
     precision=32,
     lmin=None,
     lmax=None,
-    epsilon=0.01
+    epsilon=0.01,
+    spmv="default",
+    dtype=None,
+    sampler=None,
+    use_cuda_graph=False,
+    num_streams=1
 ):
     """
     Kernel Polynomial Method using a Jackson's kernel. CUPY version
@@ -187,8 +321,18 @@ def cupykpm(
     Parameters
     ----------
 
-        H: scipy CSR sparse matrix
-            The Hermitian matrix 
+        H: scipy or cupy CSR sparse matrix
+            The Hermitian matrix. A cupy matrix is used without
+            any transfer between host and device. Only a cupy matrix
+            keeps its rescaled copy, an extra nnz-sized matrix held
+            while H is alive, so repeated calls with the same bounds
+            skip the rescaling. The copy is reused only when lmin and
+            lmax are given, since the bounds estimated by eigsh change
+            between calls, and only when H already has the dtype used
+            in the GPU, otherwise the cache is kept in a temporary
+            cast of H. A scipy matrix is copied and rescaled again in
+            every call; convert it once with
+            emate.utils.cupyops.sparse.csr_to_cupy to reuse it
         num_moments: int 
         num_vecs: int
             Number of random vectors in oder to aproximate the 
@@ -203,6 +347,38 @@ def cupykpm(
         epsilon: float
             Used to rescale the matrix eigenvalues into the interval
             [-1, 1]
+        spmv: str
+            "default", "merge_path" or "fused". The merge-path SpMV of
+            cuSPARSE is faster for matrices with a very irregular number
+            of non-zeros per row. It needs dimension*itemsize to be a
+            multiple of 128 bytes, otherwise the default SpMV is used
+            with a warning. "fused" computes each step of the
+            recurrence, including the inner products, in a single
+            kernel, which saves memory traffic. It reads H once for
+            every 8 random vectors, so it pays off for small num_vecs
+            (or num_streams splitting the vectors in small blocks)
+        dtype: str or dtype, optional
+            The dtype of the matrix in the GPU: float32, float64,
+            complex64 or complex128. If None, a real dtype is used when H
+            is real and a complex one otherwise, both with the given
+            precision. A real dtype halves the memory traffic of the
+            recurrence
+        sampler: str, optional
+            "radamacher" or "normal_complex", the random vectors used
+            to approximate the trace. Radamacher vectors are real, so a
+            real H runs the recurrence in real arithmetic, but their
+            estimator has a larger variance than the unit-phase vectors
+            of normal_complex. If None, "radamacher" is used for a real
+            dtype and "normal_complex" for a complex one
+        use_cuda_graph: bool
+            If True, a pair of steps of the Chebyshev recurrence is
+            captured once in a CUDA graph and replayed for the others.
+            It helps small and medium matrices, where the launch
+            latency of each kernel matters
+        num_streams: int
+            The random vectors are split in num_streams blocks, each
+            one running in its own CUDA stream. Useful when a single
+            product does not fill the GPU
     
     Returns
     -------
@@ -217,38 +393,69 @@ def cupykpm(
    
     """
     dimension = H.shape[0]
+    # the dtype of the arrays, H itself may be a CSR matrix of another GPU
+    # library exposing only its data, indices and indptr
+    H_dtype = H.data.dtype
 
     if (lmin is None) or (lmax is None):
-        lmin, lmax = get_bounds(H)
-
-    H  = cp.sparse.csr_matrix(
-        (
-            cp.array(H.data.astype("complex64")), 
-            cp.array(H.indices),
-            cp.array( H.indptr)
-        ), 
-        shape=H.shape, dtype="complex64"
-    )
+        if hasattr(H.data, "__cuda_array_interface__"):
+            # the bounds are computed by scipy, in the host
+            lmin, lmax = get_bounds(csr_to_cupy(H, dtype=H_dtype).get())
+        else:
+            lmin, lmax = get_bounds(H)
 
-    H, scale_fact_a, scale_fact_b = rescale_cupy(H, lmin, lmax, epsilon)
-    
-    moments = cp.array([
-        cupyops.get_moments(H, num_moments, dimension, precision=precision)
-        for i in range(num_vecs)
-    ])
-    kernel0 = cupy_jackson(num_moments, precision=precision)
- 
-    ek, rho = cupyops.apply_kernel(
-        moments,
-        kernel0,
-        dimension,
-        num_moments,
-        num_vecs,
-        extra_points
-    )
-    ek, rho = rescale_kpm(ek, rho, scale_fact_a, scale_fact_b)
+    if dtype is None:
+        if H_dtype.kind == "c":
+            dtype = "complex64"
+            if precision == 64:
+                dtype = "complex128"
+        else:
+            dtype = "float32"
+            if precision == 64:
+                dtype = "float64"
+
+    dtype = np.dtype(dtype)
+    if dtype.char not in "fdFD":
+        raise ValueError(
+            "dtype must be float32, float64, complex64 or complex128, "
+            "got %s" % dtype)
+    if dtype.kind != "c" and H_dtype.kind == "c":
+        raise ValueError("a complex matrix H needs a complex dtype")
+
+    # all the work is queued in a single non-blocking stream, so it never
+    # waits on the implicit synchronizations of the legacy default stream
+    caller_stream = cp.cuda.get_current_stream()
+    stream = cp.cuda.Stream(non_blocking=True)
+    stream.wait_event(caller_stream.record())
+    with stream:
+        H = csr_to_cupy(H, dtype=dtype)
+
+        # cuSPARSE works on sorted indices. csr_to_cupy keeps the flag of a
+        # scipy matrix, so the indices are sorted in the GPU only when the
+        # host matrix was not canonical
+        H.sum_duplicates()
+        H, scale_fact_a, scale_fact_b = rescale_cupy(
+            H, lmin, lmax, epsilon)
+
+        moments = _cupy_moments(
+            H, num_moments, dimension, num_vecs, num_streams=num_streams,
+            precision=precision, spmv=spmv, sampler=sampler,
+            use_cuda_graph=use_cuda_graph)
+        kernel0 = _cached_cupy_jackson(
+            num_moments, precision, cp.cuda.Device().id)
+
+        ek, rho = cupyops.apply_kernel(
+            moments,
+            kernel0,
+            dimension,
+            num_moments,
+            num_vecs,
+            extra_points
+        )
+        ek, rho = rescale_kpm(ek, rho, scale_fact_a, scale_fact_b)
+    caller_stream.wait_event(stream.record())
 
     return ek, rho
 
 pykpm = tfkpm
-__all__ = ["pykpm", "cupykpm", "tfkpm"]
+__all__ = ["pykpm", "cupykpm", "tfkpm", "clear_tfkpm_cache"]
@@ -114,6 +114,26 @@ def rescale_cupy(
     lmax=None,
     epsilon=0.01
 ):
+    """
+    Return a  rescaled H matrix, so that  the eigenvalues associated
+are in the range $[-1, 1]$. CUPY version
+
+    The rescaled matrix is kept in H, therefore a new call with the same
+    H, lmin, lmax and epsilon does not compute it again. If the values
+    of H are modified in place, the cached matrix is not updated.
+
+    Parameters
+    ----------
+        H: (cupy sparse matrix) A hermitian matrix in sparse format
+        lmin: (float)
+        lmax: (float)
+        epsilon: (float)
+    Returns
+    -------
+        H: (cupy sparse matrix) with eigenvalues  $\in [-1, 1]$
+        scale_fact_a: (float)
+        scale_fact_b: (float)
+    """
     n_vertices = H.shape[0]
 
     if (lmin is None) or (lmax is None):
@@ -122,9 +142,23 @@ def rescale_cupy(
     scale_fact_a = (lmax - lmin) / (2. - epsilon)
     scale_fact_b = (lmax + lmin) / 2
 
+    rescale_key = (lmin, lmax, epsilon, H.dtype, H.nnz, H.data.data.ptr)
+    cached = getattr(H, "_emate_rescaled", None)
+    if cached is not None and cached[0] == rescale_key:
+        # the cached matrix may have been computed in another stream
+        cp.cuda.get_current_stream().wait_event(cached[1])
+        return cached[2:]
+
     a = (lmax - lmin) / (2-epsilon)
     b = (lmax + lmin) / 2
-    H_rescaled = (1/a)*(H - b*cp.sparse.eye(n_vertices))
+    H_rescaled = (1/a)*(H - b*cp.sparse.eye(
+        n_vertices, dtype=H.dtype, format="csr"))
+    # the sum computed by csrgeam has sorted indices without duplicates, but
+    # the new matrix does not carry the flag of H
+    H_rescaled._has_canonical_format = True
+
+    H._emate_rescaled = (
+        rescale_key, cp.cuda.get_current_stream().record(), H_rescaled, a, b)
 
     return H_rescaled, a, b
 
@@ -102,7 +102,13 @@ def pyslq(
         tf_type = tf.float64
 
     sp_values = np.array(coo.data, dtype=np_type)
-    sp_indices = np.mat([coo.row, coo.col], dtype=np.int64).transpose()
+    sp_indices = np.stack(
+        (
+            coo.row.astype(np.int64, copy=False),
+            coo.col.astype(np.int64, copy=False)
+        ),
+        axis=1
+    )
 
     feed_dict = {
         "sp_values:0": sp_values,
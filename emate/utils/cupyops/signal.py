@@ -11,17 +11,28 @@ Available methods
         Cosine transform of type III.
 """
 
+import functools
+
 try:
     import cupy as cp
 except:
     cp = None
 
 
+@functools.lru_cache(maxsize=32)
+def _dct_twiddle(N, dtype, device_id):
+    twiddle = cp.exp(-1j*cp.pi*cp.arange(N)/(2*N)).astype(dtype)
+    # cached arrays are shared by every stream
+    cp.cuda.get_current_stream().synchronize()
+    return twiddle
+
+
 def dctIII(x, precision=32):
     """
     That implements the cosine transform of type III.
-    Here, we are using the fact that  transformation it is just 
-     the inverse of the cosine trasnform of type II.
+    Here, we are using the Makhoul's reordering, so that the
+    transformation of size N it is just the real part of a complex
+    FFT of size N, instead of a real FFT of size 2N.
 
     Args:
     -----
@@ -37,12 +48,16 @@ def dctIII(x, precision=32):
         dtype = "complex128"
 
     N = x.shape[0]
-    c = cp.empty(N+1, dtype=dtype)
+    v = cp.empty(N, dtype=dtype)
+    v[0] = x[0]
+    v[1:] = x[1:] + 1j*x[:0:-1]
+    v *= _dct_twiddle(N, dtype, cp.cuda.Device().id)
 
-    phi = cp.exp(1j*cp.pi*cp.arange(N)/(2*N))
-    c[:N] = phi*x
-    c[N] = 0.0
+    # the FFT plans are kept by the plan cache of cupy
+    v = cp.fft.fft(v).real
 
-    x_transformed = 2*N*cp.fft.irfft(c)[:N]
+    x_transformed = cp.empty(N, dtype=v.dtype)
+    x_transformed[0::2] = v[:(N+1)//2]
+    x_transformed[1::2] = v[::-1][:N//2]
 
-    return x_transformed
\ No newline at end of file
+    return x_transformed
@@ -0,0 +1,108 @@
+"""
+Sparse Matrices
+===============
+
+Functions to move sparse matrices to the GPU.
+
+
+Available methods
+-----------------
+
+    - csr_to_cupy
+        Copies a scipy sparse matrix to a cupy CSR matrix.
+"""
+import numpy as np
+try:
+    import cupy as cp
+    import cupyx.scipy.sparse
+except:
+    cp = None
+
+
+def _async_to_device(x, dtype, stream):
+    """
+    Starts the copy of a numpy array to the GPU through a pinned (page
+    locked) buffer. The pinned buffer is also returned because it must
+    stay alive until the stream is synchronized.
+    """
+    dtype = np.dtype(dtype)
+    pinned_memory = cp.cuda.alloc_pinned_memory(x.size*dtype.itemsize)
+    x_pinned = np.frombuffer(pinned_memory, dtype, x.size).reshape(x.shape)
+    x_pinned[...] = x
+
+    x_device = cp.empty(x.shape, dtype=dtype)
+    x_device.set(x_pinned, stream=stream)
+
+    return x_device, x_pinned
+
+
+def csr_to_cupy(H, dtype="complex64"):
+    """
+    Copies a sparse matrix to the GPU as a cupy CSR matrix.
+
+    The data, indices and indptr arrays are staged in pinned memory
+    and copied asynchronously in a single stream, therefore the host
+    copy of an array overlaps with the transfer of the previous one.
+    If H is already a cupy sparse matrix, or if its arrays live in the
+    GPU (__cuda_array_interface__), no transfer is made.
+
+    Parameters
+    ----------
+        H: (scipy or cupy sparse matrix, or a CSR matrix whose data,
+            indices and indptr arrays implement __cuda_array_interface__)
+        dtype: (str or dtype) dtype of the values in the GPU
+
+    Returns
+    -------
+        H: cupy CSR matrix
+    """
+    dtype = np.dtype(dtype)
+    if isinstance(H, cupyx.scipy.sparse.spmatrix):
+        H = H.tocsr()
+        if H.dtype == dtype:
+            return H
+        return H.astype(dtype)
+
+    if hasattr(H.data, "__cuda_array_interface__"):
+        # a CSR matrix from another GPU library, the arrays are only
+        # wrapped by cupy, without any copy
+        return cupyx.scipy.sparse.csr_matrix(
+            (
+                cp.asarray(H.data),
+                cp.asarray(H.indices),
+                cp.asarray(H.indptr)
+            ),
+            shape=H.shape,
+            dtype=dtype
+        )
+
+    H = H.tocsr()
+    # the cast is done on the side which moves fewer bytes through PCIe,
+    # e.g. a float32 matrix is uploaded as is and cast to complex64 on GPU
+    upload_dtype = dtype
+    if H.data.dtype.itemsize < dtype.itemsize:
+        upload_dtype = H.data.dtype
+
+    stream = cp.cuda.Stream(non_blocking=True)
+    # the device buffers come from the memory pool of the current stream,
+    # a recycled block may still be used by the work queued there
+    stream.wait_event(cp.cuda.get_current_stream().record())
+    data, data_pinned = _async_to_device(H.data, upload_dtype, stream)
+    indices, indices_pinned = _async_to_device(
+        H.indices, H.indices.dtype, stream)
+    indptr, indptr_pinned = _async_to_device(
+        H.indptr, H.indptr.dtype, stream)
+    stream.synchronize()
+
+    H_device = cupyx.scipy.sparse.csr_matrix(
+        (data, indices, indptr),
+        shape=H.shape,
+        dtype=dtype
+    )
+    # the indices were copied as they are, so a canonical scipy matrix
+    # does not need to be sorted again in the GPU
+    H_device._has_canonical_format = bool(H.has_canonical_format)
+
+    return H_device
+
+__all__ = ["csr_to_cupy"]
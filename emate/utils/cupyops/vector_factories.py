@@ -0,0 +1,70 @@
+"""
+Vector Factories
+================
+
+Random vectors used by the stochastic trace estimator.
+
+Available methods
+-----------------
+
+    - normal_complex
+
+    - radamacher
+"""
+
+try:
+    import cupy as cp
+except:
+    cp = None
+
+
+def normal_complex(shape, precision=32):
+    r"""Generates a set of complex random vectors
+    .. math::
+        v = [e^{2\pi i \phi_0}\dots e^{2\pi i \phi_n}]
+
+    Parameters
+    ----------
+        shape: (int, int) dimension matrix
+        precision: (int) 32 or 64
+
+    Returns
+    ------
+        vector: cupy array(shape=shape, dtype=cp_complex)
+
+    """
+    cp_float = cp.float64
+    cp_complex = cp.complex128
+    if precision == 32:
+        cp_float = cp.float32
+        cp_complex = cp.complex64
+
+    random_phases = 2*cp.pi*cp.random.random(shape, dtype=cp_float)
+    vector = cp.exp(1j*random_phases).astype(cp_complex, copy=False)
+    return vector
+
+
+def radamacher(shape, precision=32):
+    """Generates a set of Radamacher vectors, i.e., each entry is -1 or 1
+    with the same probability.
+
+    Parameters
+    ----------
+        shape: (int, int) dimension matrix
+        precision: (int) 32 or 64
+
+    Returns
+    ------
+        vector: cupy array(shape=shape, dtype=cp_float)
+
+    """
+    cp_float = cp.float64
+    if precision == 32:
+        cp_float = cp.float32
+
+    signs = cp.random.randint(0, 2, size=shape, dtype=cp.int8)
+    vector = (2*signs - 1).astype(cp_float)
+    return vector
+
+
+__all__ = ["normal_complex", "radamacher"]
@@ -177,7 +177,13 @@ def scipy2tensor(scipy_sp_a, precision=32):
     data = np.array(coo.data, dtype=np_type)
 
     shape = np.array(coo.shape, dtype=np.int32)
-    indices = np.mat([coo.row, coo.col], dtype=np.float32).transpose()
+    indices = np.stack(
+        (
+            coo.row.astype(np.int64, copy=False),
+            coo.col.astype(np.int64, copy=False)
+        ),
+        axis=1
+    )
     sp_a = tf.SparseTensor(indices, data, shape)
     return sp_a
 